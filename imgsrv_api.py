@@ -1,35 +1,72 @@
 """
 Image Microservice (DB-free, multi-user safe)
 - REST API for uploading images to a per-project directory
-- Generates original / medium / thumbnail / game(50x50)
+- Generates original / medium / thumbnail / game(50x50) in the background; an upload
+  answers 202 and its meta entry reads "processing" until the sizes exist
 - Uses storage/projects/<project_id>/meta.json as lightweight metadata store
 - First uploaded image becomes the project's primary thumbnail (cover)
 
 Concurrency:
 - Uses a per-project FILE LOCK (meta.lock) so concurrent users AND multiple server
   processes/workers won't corrupt meta.json or race primary selection.
+- Read-only endpoints don't take the lock; meta.json is replaced atomically, so readers
+  always see a complete file.
 """
 
 from __future__ import annotations
 
-import json
+import asyncio
+import errno
+import hashlib
+import logging
+import multiprocessing
 import os
-import uuid
+import secrets
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Literal, Optional
-
-from fastapi import FastAPI, File, HTTPException, UploadFile
-from fastapi.responses import FileResponse
-from PIL import Image
+from typing import Any, AsyncIterator, Dict, List, Literal, Optional, Tuple
+from urllib.parse import quote
+
+import aiofiles
+import orjson
+from fastapi import BackgroundTasks, FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, Response
+from PIL import Image, features
 from filelock import FileLock, Timeout
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 # -----------------------------
 # Config
 # -----------------------------
-app = FastAPI(title="Image Microservice (DB-free, multi-user safe)")
+@asynccontextmanager
+async def _lifespan(app: FastAPI) -> AsyncIterator[None]:
+    _check_jpeg_codec()
+    # One pool per lifespan, not per import, so a second startup in the same process
+    # (tests, embedded restarts) gets a live pool instead of one already shut down
+    app.state.render_executor = _new_render_executor()
+    # Not awaited: startup shouldn't wait on a scan of the whole storage tree
+    sweep = asyncio.create_task(_sweep_storage())
+    try:
+        yield
+    finally:
+        sweep.cancel()
+        app.state.render_executor.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(title="Image Microservice (DB-free, multi-user safe)", lifespan=_lifespan)
+logger = logging.getLogger("imgsrv")
 
 STORAGE_ROOT = Path("storage/projects")
+# Content-addressed renders, keyed by a hash of the upload bytes plus the render settings.
+# Project files are hard links into here, so re-uploading the same bytes skips
+# decode/resize/encode. A dir is removed once no project links to it any more.
+CAS_ROOT = Path("storage/cas")
 
 MEDIUM_MAX = (1600, 1600)
 THUMB_MAX = (400, 400)
@@ -38,22 +75,86 @@ GAME_IMG = (50, 50)
 JPEG_QUALITY_ORIGINAL = 92
 JPEG_QUALITY_DERIVED = 85
 
+# Sizes that also get a WebP copy (<image_id>.webp next to the .jpg), served to clients
+# that accept image/webp. These are the most requested sizes, so the smaller files pay off.
+WEBP_SIZES = ("thumb", "game")
+WEBP_QUALITY = 80
+
+# Bump when a change to the rendering code alters its output. Together with the size and
+# quality settings above it is part of every CAS key, so renders made with other settings
+# are never reused.
+RENDER_VERSION = 2
+
+# Small, hot sizes whose bytes are served from an in-process LRU instead of the disk
+MEMORY_CACHED_SIZES = ("thumb", "game")
+MEMORY_CACHE_MAX_FILES = 4096
+
+# Uploads are streamed to disk in chunks of this size (bytes)
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Larger uploads are rejected with 413 (bytes). Checked on the raw request body (plus
+# MULTIPART_OVERHEAD_BYTES for the form framing) before Starlette spools it to a temp
+# file, then again on the file itself while it is streamed into storage.
+MAX_UPLOAD_BYTES = 50 << 20
+MULTIPART_OVERHEAD_BYTES = 64 << 10
+
+# Max number of projects whose parsed meta.json is kept in memory per process
+META_CACHE_MAX = 1024
+
+# When set (e.g. "/_internal"), image GETs only do the meta checks and hand the file
+# transfer to the reverse proxy via X-Accel-Redirect (nginx sendfile). See README.
+ACCEL_REDIRECT_PREFIX: Optional[str] = None
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
 # How long to wait for a project lock before failing (seconds)
 LOCK_TIMEOUT_SECS = 15
+# Tries at removing an image whose background render failed
+DISCARD_ATTEMPTS = 3
+
+# Decode/resize/encode runs in worker processes so uploads don't block the event loop
+RENDER_WORKERS = os.cpu_count() or 1
+# Workers are started lazily, from a process already running threadpool threads; a plain
+# fork() can leave a child stuck on a lock one of those threads held. forkserver/spawn
+# start workers from a clean process instead.
+RENDER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
 
 ImageSize = Literal["original", "medium", "thumb", "game"]
 
 
+def _check_jpeg_codec() -> None:
+    # Resize/encode throughput assumes pillow-simd built against libjpeg-turbo (see README)
+    if not features.check_feature("libjpeg_turbo"):
+        logger.warning("PIL is not using libjpeg-turbo (jpeglib %s); JPEG encode/decode will be slow.",
+                       features.version("jpg"))
+
+
+def _new_render_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context(RENDER_START_METHOD)
+    )
+
+
 # -----------------------------
 # Helpers: filesystem layout
 # -----------------------------
+# Projects whose directories this process has already created
+_ENSURED_PROJECTS: set[str] = set()
+_ENSURED_LOCK = threading.Lock()
+
+
 def _project_base(project_id: str) -> Path:
-    base = STORAGE_ROOT / project_id
-    (base / "original").mkdir(parents=True, exist_ok=True)
-    (base / "medium").mkdir(parents=True, exist_ok=True)
-    (base / "thumb").mkdir(parents=True, exist_ok=True)
-    (base / "game").mkdir(parents=True, exist_ok=True)
-    return base
+    # Pure path building; only writers create directories (_ensure_project_dirs)
+    return STORAGE_ROOT / project_id
+
+
+def _ensure_project_dirs(project_id: str) -> None:
+    if project_id in _ENSURED_PROJECTS:
+        return
+    base = _project_base(project_id)
+    for sub in ("original", "medium", "thumb", "game"):
+        (base / sub).mkdir(parents=True, exist_ok=True)
+    with _ENSURED_LOCK:
+        _ENSURED_PROJECTS.add(project_id)
 
 
 def _meta_path(project_id: str) -> Path:
@@ -76,6 +177,243 @@ def _paths_for(project_id: str, image_id: str, ext: str = "jpg") -> Dict[str, Pa
     }
 
 
+def _urls_for(project_id: str, image_id: str) -> Dict[str, str]:
+    prefix = f"/projects/{project_id}/images/{image_id}?size="
+    return {
+        "original": prefix + "original",
+        "medium": prefix + "medium",
+        "thumb": prefix + "thumb",
+        "game": prefix + "game",
+    }
+
+
+def _render_settings_tag() -> str:
+    settings = (RENDER_VERSION, MEDIUM_MAX, THUMB_MAX, GAME_IMG, JPEG_QUALITY_ORIGINAL,
+                JPEG_QUALITY_DERIVED, WEBP_SIZES, WEBP_QUALITY)
+    return hashlib.blake2b(repr(settings).encode(), digest_size=4).hexdigest()
+
+
+def _cas_paths(cas_dir: Path) -> Dict[str, Path]:
+    return {size: cas_dir / f"{size}.jpg" for size in ("original", "medium", "thumb", "game")}
+
+
+def _cas_lock() -> FileLock:
+    # One lock for the whole CAS: linking into a dir and removing it are short, and they
+    # must not interleave across projects or processes
+    CAS_ROOT.mkdir(parents=True, exist_ok=True)
+    return FileLock(str(CAS_ROOT / "cas.lock"))
+
+
+def _with_cas_lock() -> FileLock:
+    lock = _cas_lock()
+    try:
+        lock.acquire(timeout=LOCK_TIMEOUT_SECS)
+    except Timeout:
+        raise HTTPException(status_code=503, detail="Image storage is busy. Try again in a moment.")
+    return lock
+
+
+def _render_lock(image_id: str) -> FileLock:
+    # Held for the whole life of an upload, from the first byte written until its renders
+    # are linked (or it is dropped). Startup sweeps leave an upload alone while it's held.
+    # Not thread-local: the sweep acquires it on a worker thread and the render job,
+    # running on the event loop, releases it.
+    CAS_ROOT.mkdir(parents=True, exist_ok=True)
+    return FileLock(str(CAS_ROOT / f"{image_id}.render.lock"), thread_local=False)
+
+
+def _try_render_lock(image_id: str) -> Optional[FileLock]:
+    lock = _render_lock(image_id)
+    try:
+        lock.acquire(timeout=0)
+    except Timeout:
+        return None
+    return lock
+
+
+def _drop_render_lock(lock: FileLock) -> None:
+    # Lock files are per upload, so remove it rather than leave one behind per image.
+    # Release first: on Windows the held lock file can't be deleted. Best effort, since
+    # another process may already have reopened it; the startup sweep removes leftovers.
+    lock.release()
+    with suppress(OSError):
+        Path(lock.lock_file).unlink()
+
+
+def _gc_cas_dir(cas_dir: Path) -> None:
+    # Call with the CAS lock held. original.jpg is hard-linked into every project image
+    # using this dir, so a link count of 1 means only the CAS copy is left.
+    try:
+        if (cas_dir / "original.jpg").stat().st_nlink > 1:
+            return
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(cas_dir, ignore_errors=True)
+
+
+def _release_cas_dir(cas_dir: Path) -> None:
+    # Best effort: on a lock timeout the dir is left for the next startup sweep
+    lock = _cas_lock()
+    try:
+        lock.acquire(timeout=LOCK_TIMEOUT_SECS)
+    except Timeout:
+        logger.warning("CAS busy; leaving %s for the next sweep.", cas_dir)
+        return
+    try:
+        _gc_cas_dir(cas_dir)
+    finally:
+        lock.release()
+
+
+def _sweep_cas() -> None:
+    """
+    Remove CAS dirs that no project links to. Deletes normally release their dir
+    right away; this catches dirs left over from older versions or lock timeouts.
+    Also removes render dirs and render locks left behind by a dead worker.
+    """
+    if not CAS_ROOT.is_dir():
+        return
+    for entry in os.scandir(CAS_ROOT):
+        if entry.name.endswith(".tmp"):
+            # <cas name>.<image_id>.tmp: a render that never finished, unless its upload is live
+            lock = _try_render_lock(entry.name.split(".")[1])
+            if lock:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                _drop_render_lock(lock)
+        elif entry.name.endswith(".render.lock"):
+            # Left behind by a worker that died mid-upload
+            lock = _try_render_lock(entry.name.split(".")[0])
+            if lock:
+                _drop_render_lock(lock)
+        elif entry.is_dir():
+            _release_cas_dir(Path(entry.path))
+
+
+# os.link errors meaning the filesystem can't hard-link these two paths; anything else is
+# a real error and must not be papered over with a copy
+_NO_HARDLINK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK}
+
+
+def _link_or_copy(src: Path, dest: Path) -> None:
+    # Link (or copy) to a temp name, then swap it in. A resumed render finds dest already
+    # there, possibly as a hard link into another CAS dir: it must be replaced, never
+    # written through.
+    tmp = dest.with_name(dest.name + ".link")
+    tmp.unlink(missing_ok=True)
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno not in _NO_HARDLINK_ERRNOS:
+                raise
+            # Filesystem without hard links (or CAS on another device)
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    finally:
+        # Also needed on success: rename() is a no-op when tmp and dest are already links
+        # to the same file, leaving tmp behind
+        tmp.unlink(missing_ok=True)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in inm.split(",")]
+    return "*" in tags or etag in tags
+
+
+def _unlink_image_files(paths: Dict[str, Path], cas_name: Optional[str] = None) -> None:
+    for k in ("original", "medium", "thumb", "game"):
+        paths[k].unlink(missing_ok=True)
+    for k in WEBP_SIZES:
+        paths[k].with_suffix(".webp").unlink(missing_ok=True)
+    # Entries from before CAS GC carry no "cas" name; the startup sweep collects those
+    if cas_name:
+        _release_cas_dir(CAS_ROOT / cas_name)
+
+
+def _link_cas_files(cas_dir: Path, paths: Dict[str, Path]) -> None:
+    # Call with the CAS lock held
+    for size, src in _cas_paths(cas_dir).items():
+        _link_or_copy(src, paths[size])
+        if size in WEBP_SIZES and src.with_suffix(".webp").exists():
+            _link_or_copy(src.with_suffix(".webp"), paths[size].with_suffix(".webp"))
+    # Without hard links the project got copies; don't keep a second full set around
+    _gc_cas_dir(cas_dir)
+
+
+def _link_from_cas(cas_dir: Path, paths: Dict[str, Path]) -> bool:
+    # Returns False if there are no renders for these bytes (yet)
+    lock = _with_cas_lock()
+    try:
+        if not cas_dir.is_dir():
+            return False
+        _link_cas_files(cas_dir, paths)
+        return True
+    finally:
+        lock.release()
+
+
+def _publish_to_cas(render_dir: Path, cas_dir: Path, paths: Dict[str, Path]) -> None:
+    # Move a finished render into the CAS and link it into the project in one locked step,
+    # so the dir can't be collected in between
+    lock = _with_cas_lock()
+    try:
+        try:
+            os.replace(render_dir, cas_dir)
+        except OSError:
+            # A concurrent upload of the same bytes got there first; its renders are identical
+            pass
+        _link_cas_files(cas_dir, paths)
+    finally:
+        lock.release()
+
+
+@lru_cache(maxsize=MEMORY_CACHE_MAX_FILES)
+def _read_small_image(path: Path, mtime_ns: int, size: int) -> bytes:
+    # mtime_ns/size are part of the cache key, so a replaced file is never served stale
+    return path.read_bytes()
+
+
+def _image_response(
+    request: Request, path: Path, cache_control: str, webp_variant: bool = False, in_memory: bool = False
+) -> Response:
+    """
+    Serve an image file, answering 304 when the client already has this exact file.
+    With webp_variant, the .webp copy is served instead if the client accepts it.
+    With in_memory, the bytes come from the _read_small_image LRU (small sizes only).
+    Raises FileNotFoundError if the JPEG is missing.
+    """
+    media_type = "image/jpeg"
+    headers = {"Cache-Control": cache_control}
+    st: Optional[os.stat_result] = None
+    if webp_variant:
+        headers["Vary"] = "Accept"
+        if "image/webp" in request.headers.get("accept", ""):
+            webp = path.with_suffix(".webp")
+            try:
+                st = webp.stat()
+                path, media_type = webp, "image/webp"
+            except FileNotFoundError:
+                pass  # rendered before WebP copies existed, or PIL built without WebP
+    if st is None:
+        st = path.stat()
+
+    headers["ETag"] = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+    if _etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if ACCEL_REDIRECT_PREFIX:
+        # project_id is client-supplied: percent-encode so the header stays ASCII and nginx
+        # gets a well-formed internal URI (it decodes it before mapping to the alias)
+        headers["X-Accel-Redirect"] = f"{ACCEL_REDIRECT_PREFIX}/{quote(path.relative_to(STORAGE_ROOT).as_posix())}"
+        return Response(headers=headers, media_type=media_type)
+    if in_memory:
+        return Response(_read_small_image(path, st.st_mtime_ns, st.st_size), headers=headers, media_type=media_type)
+    # Reuse our stat so FileResponse doesn't stat the file again
+    return FileResponse(path, headers=headers, media_type=media_type, stat_result=st)
+
+
 def _utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
@@ -92,14 +430,63 @@ def _read_meta(project_id: str) -> Dict[str, Any]:
     if not mp.exists():
         return _default_meta(project_id)
     try:
-        return json.loads(mp.read_text(encoding="utf-8"))
+        return orjson.loads(mp.read_bytes())
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to read meta.json for project {project_id}: {e}")
 
 
+# project_id -> ((st_mtime_ns, st_size, st_ino), value). Every os.replace creates a new
+# file, so the stat tuple changes on each write, including writes from other processes.
+MetaStamp = Tuple[int, int, int]
+# Parsed meta plus an image id -> image dict index for O(1) lookups
+MetaIndex = Dict[str, Dict[str, Any]]
+_META_CACHE: Dict[str, Tuple[MetaStamp, Dict[str, Any], MetaIndex]] = {}
+_LIST_CACHE: Dict[str, Tuple[MetaStamp, bytes]] = {}
+_META_CACHE_LOCK = threading.Lock()
+
+
+def _meta_stamp(project_id: str) -> Optional[MetaStamp]:
+    try:
+        st = _meta_path(project_id).stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _cache_put(cache: Dict[str, Any], project_id: str, entry: Any) -> None:
+    with _META_CACHE_LOCK:
+        if project_id not in cache and len(cache) >= META_CACHE_MAX:
+            cache.pop(next(iter(cache)))
+        cache[project_id] = entry
+
+
+def _read_meta_unlocked(project_id: str) -> Tuple[Dict[str, Any], MetaIndex]:
+    """
+    Lock-free, cached read for GET endpoints. Returns (meta, index by image id); both are
+    shared, don't mutate them. Writers swap meta.json in with os.replace, so a reader sees
+    either the old or the new file.
+    """
+    stamp = _meta_stamp(project_id)
+    if stamp is None:
+        return _default_meta(project_id), {}
+    cached = _META_CACHE.get(project_id)
+    if cached and cached[0] == stamp:
+        return cached[1], cached[2]
+
+    # Retry once in case the read raced a rename
+    try:
+        meta = _read_meta(project_id)
+    except HTTPException:
+        meta = _read_meta(project_id)
+
+    index = {img["id"]: img for img in meta.get("images", [])}
+    _cache_put(_META_CACHE, project_id, (stamp, meta, index))
+    return meta, index
+
+
 def _atomic_write_json(path: Path, data: Dict[str, Any]) -> None:
     tmp = path.with_suffix(".tmp")
-    tmp.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+    tmp.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
     os.replace(tmp, path)
 
 
@@ -109,6 +496,9 @@ def _write_meta(project_id: str, meta: Dict[str, Any]) -> None:
         _atomic_write_json(mp, meta)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to write meta.json for project {project_id}: {e}")
+    with _META_CACHE_LOCK:
+        _META_CACHE.pop(project_id, None)
+        _LIST_CACHE.pop(project_id, None)
 
 
 def _find_image_in_meta(meta: Dict[str, Any], image_id: str) -> Optional[Dict[str, Any]]:
@@ -120,103 +510,439 @@ def _find_image_in_meta(meta: Dict[str, Any], image_id: str) -> Optional[Dict[st
 
 def _with_project_lock(project_id: str):
     """
-    Context manager for per-project lock. Ensures cross-process safety.
+    Acquire the per-project lock and return it. Ensures cross-process safety.
+    Only needed around read-modify-write of meta.json; readers use _read_meta_unlocked.
     """
+    _ensure_project_dirs(project_id)
     lock = FileLock(str(_lock_path(project_id)))
     try:
-        return lock.acquire(timeout=LOCK_TIMEOUT_SECS)
+        lock.acquire(timeout=LOCK_TIMEOUT_SECS)
     except Timeout:
         raise HTTPException(status_code=503, detail="Project is busy. Try again in a moment.")
+    return lock
+
+
+def _drop_from_meta(meta: Dict[str, Any], image_id: str) -> None:
+    meta["images"] = [x for x in meta["images"] if x.get("id") != image_id]
+    if meta.get("primary_image_id") == image_id:
+        meta["primary_image_id"] = meta["images"][0]["id"] if meta["images"] else None
+
+
+def _update_image_in_meta(project_id: str, image_id: str, changes: Dict[str, Any]) -> bool:
+    # Returns False if the image is no longer in meta.json (deleted meanwhile)
+    lock_handle = _with_project_lock(project_id)
+    try:
+        meta = _read_meta(project_id)
+        img = _find_image_in_meta(meta, image_id)
+        if not img:
+            return False
+        img.update(changes)
+        _write_meta(project_id, meta)
+        return True
+    finally:
+        lock_handle.release()
+
+
+def _discard_image(project_id: str, image_id: str, paths: Dict[str, Path], cas_name: Optional[str]) -> None:
+    # Drop an upload whose render failed or can't be resumed. Images that are already
+    # "ready" (another run of the same render got there first) are left alone.
+    lock_handle = _with_project_lock(project_id)
+    try:
+        meta = _read_meta(project_id)
+        img = _find_image_in_meta(meta, image_id)
+        if img and img.get("status") != "processing":
+            return
+        if img:
+            _drop_from_meta(meta, image_id)
+            _write_meta(project_id, meta)
+        _unlink_image_files(paths, cas_name)
+    finally:
+        lock_handle.release()
+
+
+def _add_image_to_meta(project_id: str, entry: Dict[str, Any]) -> bool:
+    """
+    Append a new image to meta.json in a single locked read-modify-write. Returns whether it
+    became the primary image; deciding that at the append point keeps two simultaneous
+    "first uploads" from both becoming primary.
+    """
+    lock_handle = _with_project_lock(project_id)
+    try:
+        meta = _read_meta(project_id)
+        meta["images"].append(entry)
+        is_primary = meta.get("primary_image_id") is None
+        if is_primary:
+            meta["primary_image_id"] = entry["id"]
+        _write_meta(project_id, meta)
+    finally:
+        # release file lock
+        lock_handle.release()
+    return is_primary
 
 
 # -----------------------------
 # Helpers: image processing
 # -----------------------------
-def _save_as_jpeg(src_path: Path, dest_path: Path, quality: int) -> None:
-    with Image.open(src_path) as im:
-        im = im.convert("RGB")
-        im.save(dest_path, format="JPEG", quality=quality, optimize=True)
+# Upload formats we accept, as PIL format names. Each is sniffed with the installed PIL
+# plugin's own signature check, so AVIF (and HEIF, with pillow-heif) are only accepted
+# when this PIL can decode them. Vector/exotic plugins (EPS, WMF, FITS, ...) stay excluded.
+UPLOAD_FORMATS = ("JPEG", "PNG", "GIF", "WEBP", "BMP", "TIFF", "ICO", "JPEG2000", "AVIF", "HEIF")
+
+
+def _installed_upload_formats() -> List[str]:
+    Image.init()
+    return [fmt for fmt in UPLOAD_FORMATS if fmt in Image.OPEN]
+
+
+def _sniff_image_format(head: bytes) -> Optional[str]:
+    for fmt in _installed_upload_formats():
+        accept = Image.OPEN[fmt][1]
+        # Plugins return a str when they recognize the file but lack codec support
+        result = accept(head) if accept else False
+        if result and not isinstance(result, str):
+            return fmt
+    return None
+
 
+def _decode_upload(src_path: Path) -> Image.Image:
+    # Decode the upload once; every size is derived from this RGB image.
+    # No im.draft() here: JPEG DCT-scaled decoding would only help the thumb/game
+    # branch, but the original is re-encoded at full resolution anyway and the
+    # small sizes cascade from medium, so a second reduced decode costs more than it saves.
+    with Image.open(src_path, formats=_installed_upload_formats()) as src:
+        return src.convert("RGB")
 
-def _save_resized(src_path: Path, dest_path: Path, max_size: tuple[int, int], quality: int) -> None:
-    # Fit within max_size, preserve aspect ratio
-    with Image.open(src_path) as im:
-        im = im.convert("RGB")
-        im.thumbnail(max_size)
-        im.save(dest_path, format="JPEG", quality=quality, optimize=True)
 
+def _save_as_jpeg(im: Image.Image, dest_path: Path, quality: int) -> None:
+    # Only the original gets optimize=True (second Huffman pass). On the derived sizes
+    # it roughly doubles encode time to save a few dozen bytes.
+    im.save(dest_path, format="JPEG", quality=quality, optimize=True)
 
-def _save_fixed_square(src_path: Path, dest_path: Path, size: tuple[int, int], quality: int) -> None:
+
+def _save_resized(im: Image.Image, dest_path: Path, max_size: tuple[int, int], quality: int) -> Image.Image:
+    # Fit within max_size, preserve aspect ratio (never upscale). Returns the resized image
+    # so smaller sizes can be derived from it instead of the full-size source.
+    scale = min(max_size[0] / im.width, max_size[1] / im.height, 1.0)
+    size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+    if size != im.size:
+        # resize() returns a new image, so `im` (still being encoded as the original on
+        # another thread) is left alone without a full-size copy.
+        # reducing_gap=1.0: a cheap integer reduce() box pass first (whenever the ratio is
+        # 2x or more), leaving LANCZOS less than 2x to cover. With the default gap of 2.0
+        # the reduce only kicks in at 4x, so a 12-24 MP photo -> medium (2.5-3.75x) was
+        # LANCZOS-resampled at full resolution.
+        im = im.resize(size, Image.Resampling.LANCZOS, reducing_gap=1.0)
+    im.save(dest_path, format="JPEG", quality=quality, progressive=False)
+    return im
+
+
+def _save_fixed_square(im: Image.Image, dest_path: Path, size: tuple[int, int], quality: int) -> Image.Image:
     # Exact WxH: center-crop square then resize
     target_w, target_h = size
-    with Image.open(src_path) as im:
-        im = im.convert("RGB")
-        w, h = im.size
-        side = min(w, h)
-        left = (w - side) // 2
-        top = (h - side) // 2
-        im = im.crop((left, top, left + side, top + side))
-        im = im.resize((target_w, target_h))
-        im.save(dest_path, format="JPEG", quality=quality, optimize=True)
+    w, h = im.size
+    side = min(w, h)
+    left = (w - side) // 2
+    top = (h - side) // 2
+    im = im.crop((left, top, left + side, top + side))
+    im = im.resize((target_w, target_h), Image.Resampling.BOX)
+    im.save(dest_path, format="JPEG", quality=quality, progressive=False)
+    return im
+
+
+def _save_webp(im: Image.Image, jpeg_path: Path) -> None:
+    # WebP copy next to the JPEG; skipped when PIL was built without libwebp
+    if features.check("webp"):
+        im.save(jpeg_path.with_suffix(".webp"), format="WEBP", quality=WEBP_QUALITY, method=4)
+
+
+def _render_all(src_path: Path, paths: Dict[str, Path]) -> None:
+    """
+    Runs in a render worker process (app.state.render_executor): decode once, then write all four sizes
+    (plus the WEBP_SIZES copies). Each size cascades from the previous one so only medium
+    touches the full-size pixels.
+    """
+    im = _decode_upload(src_path)
+    # The full-size original encode is the slowest step and only reads `im`. Pillow releases
+    # the GIL while encoding/resampling, so run it alongside the derived-size chain.
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        original = pool.submit(_save_as_jpeg, im, paths["original"], JPEG_QUALITY_ORIGINAL)
+        medium = _save_resized(im, paths["medium"], MEDIUM_MAX, quality=JPEG_QUALITY_DERIVED)
+        thumb = _save_resized(medium, paths["thumb"], THUMB_MAX, quality=JPEG_QUALITY_DERIVED)
+        game = _save_fixed_square(thumb, paths["game"], GAME_IMG, quality=JPEG_QUALITY_DERIVED)
+        _save_webp(thumb, paths["thumb"])
+        _save_webp(game, paths["game"])
+        original.result()
+
+
+def _image_dims(path: Path) -> Dict[str, int]:
+    # Image.open only parses the header here; no pixels are decoded
+    with Image.open(path, formats=_installed_upload_formats()) as im:
+        width, height = im.size
+    return {"width": width, "height": height}
+
+
+def _original_info(path: Path) -> Dict[str, int]:
+    # Recorded in meta.json so list responses never need to open or stat image files
+    return {**_image_dims(path), "size_bytes": path.stat().st_size}
+
+
+async def _render_into_cas(src_path: Path, cas_dir: Path, image_id: str, paths: Dict[str, Path]) -> None:
+    # Convert + generate sizes off the event loop, into a private dir that is
+    # renamed into place so a CAS dir is only ever visible complete
+    render_dir = CAS_ROOT / f"{cas_dir.name}.{image_id}.tmp"
+    # Left over if this is a resumed render (see _sweep_projects); we hold its render lock
+    shutil.rmtree(render_dir, ignore_errors=True)
+    render_dir.mkdir(parents=True)
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            # Absolute paths: workers run in the forkserver's cwd, not necessarily ours
+            app.state.render_executor, _render_all, src_path.absolute(), _cas_paths(render_dir.absolute())
+        )
+        await run_in_threadpool(_publish_to_cas, render_dir, cas_dir, paths)
+    finally:
+        shutil.rmtree(render_dir, ignore_errors=True)
+
+
+async def _finish_upload(project_id: str, image_id: str, tmp_upload: Path, cas_dir: Path,
+                         paths: Dict[str, Path], render_lock: FileLock) -> None:
+    """
+    Background half of upload_image: render the sizes, link them into the project and
+    flip the meta entry from "processing" to "ready". A failed render drops the image.
+    Takes over render_lock from the caller and releases it when done.
+    """
+    keep_upload = False
+    try:
+        await _render_into_cas(tmp_upload, cas_dir, image_id, paths)
+        changes = {"status": "ready", "size_bytes": paths["original"].stat().st_size, "cas": cas_dir.name}
+        if not await run_in_threadpool(_update_image_in_meta, project_id, image_id, changes):
+            # Deleted while processing: its files were linked after the delete ran
+            await run_in_threadpool(_unlink_image_files, paths, cas_dir.name)
+    except asyncio.CancelledError:
+        # Shutting down: keep the upload so the next startup sweep renders it again
+        keep_upload = True
+        raise
+    except Exception:
+        logger.exception("Rendering image %s in project %s failed; dropping it.", image_id, project_id)
+        for attempt in range(1, DISCARD_ATTEMPTS + 1):
+            try:
+                await run_in_threadpool(_discard_image, project_id, image_id, paths, cas_dir.name)
+                break
+            except Exception:
+                # e.g. 503 on a busy project. If every attempt fails, the entry stays
+                # "processing" until the next startup sweep drops it (its upload is gone).
+                logger.exception("Dropping image %s in project %s failed (attempt %d/%d).",
+                                 image_id, project_id, attempt, DISCARD_ATTEMPTS)
+    finally:
+        if not keep_upload:
+            tmp_upload.unlink(missing_ok=True)
+        _drop_render_lock(render_lock)
+
+
+def _recover_upload(project_id: str, image_id: str) -> Optional[Tuple[Any, ...]]:
+    """
+    Settle an upload whose render never finished. Returns _finish_upload arguments if it
+    should be rendered again (its .upload file is still there); otherwise drops the entry
+    and/or the stray upload file and returns None. Uploads still held by a live worker
+    are skipped.
+    """
+    lock = _try_render_lock(image_id)
+    if lock is None:
+        return None
+    try:
+        img = _find_image_in_meta(_read_meta(project_id), image_id)
+        paths = _paths_for(project_id, image_id, (img or {}).get("ext", "jpg"))
+        tmp_upload = paths["original"].with_suffix(".upload")
+        processing = img is not None and img.get("status") == "processing"
+        if processing and img.get("cas") and tmp_upload.exists():
+            # Re-key on the current render settings; the digest part is the upload hash
+            cas_dir = CAS_ROOT / f"{img['cas'].rsplit('-', 1)[0]}-{_render_settings_tag()}"
+            return project_id, image_id, tmp_upload, cas_dir, paths, lock
+        if processing:
+            logger.warning("Dropping image %s in project %s: its upload is gone.", image_id, project_id)
+            _discard_image(project_id, image_id, paths, img.get("cas"))
+        tmp_upload.unlink(missing_ok=True)
+    except Exception:
+        logger.exception("Recovering image %s in project %s failed.", image_id, project_id)
+    _drop_render_lock(lock)
+    return None
+
+
+def _sweep_projects() -> List[Tuple[Any, ...]]:
+    """
+    Find uploads left unfinished by a worker restart or crash: "processing" entries and
+    stray <image_id>.upload files. Returns the ones to render again (see _recover_upload).
+    """
+    jobs: List[Tuple[Any, ...]] = []
+    if not STORAGE_ROOT.is_dir():
+        return jobs
+    for project in os.scandir(STORAGE_ROOT):
+        if not project.is_dir():
+            continue
+        project_id = project.name
+        try:
+            meta = _read_meta(project_id)
+        except HTTPException:
+            logger.exception("Skipping project %s in the startup sweep.", project_id)
+            continue
+        image_ids = {img["id"] for img in meta.get("images", []) if img.get("status") == "processing"}
+        original_dir = _project_base(project_id) / "original"
+        if original_dir.is_dir():
+            image_ids.update(e.name.removesuffix(".upload") for e in os.scandir(original_dir)
+                             if e.name.endswith(".upload"))
+        for image_id in image_ids:
+            job = _recover_upload(project_id, image_id)
+            if job:
+                jobs.append(job)
+    return jobs
+
+
+# Resumed renders; referenced here so the event loop doesn't garbage-collect them
+_RESUMED_RENDERS: set[asyncio.Task] = set()
+
+
+async def _sweep_storage() -> None:
+    # Runs once per worker at startup. Every step skips uploads whose render lock is
+    # held, so workers that are already serving are never disturbed.
+    try:
+        await run_in_threadpool(_sweep_cas)
+        jobs = await run_in_threadpool(_sweep_projects)
+    except Exception:
+        logger.exception("Startup storage sweep failed.")
+        return
+    for job in jobs:
+        logger.info("Resuming render of image %s in project %s.", job[1], job[0])
+        task = asyncio.create_task(_finish_upload(*job))
+        _RESUMED_RENDERS.add(task)
+        task.add_done_callback(_RESUMED_RENDERS.discard)
+
+
+# -----------------------------
+# Request body size limit
+# -----------------------------
+class _BodySizeLimit:
+    """
+    Rejects request bodies over MAX_UPLOAD_BYTES (+ multipart framing) with 413 before the
+    form is parsed; otherwise Starlette would spool the whole body to a temp file first.
+    Uses Content-Length when sent and counts the bytes as they arrive when it isn't.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limit = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            await JSONResponse({"detail": "Upload too large."}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised inside form parsing; FastAPI re-raises HTTPException as is
+                    raise HTTPException(status_code=413, detail="Upload too large.")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(_BodySizeLimit)
 
 
 # -----------------------------
 # API: Upload
 # -----------------------------
 @app.post("/projects/{project_id}/images")
-async def upload_image(project_id: str, file: UploadFile = File(...)) -> Dict[str, Any]:
+async def upload_image(
+    project_id: str, response: Response, background_tasks: BackgroundTasks, file: UploadFile = File(...)
+) -> Dict[str, Any]:
     if not file.content_type or not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="Only image uploads are allowed.")
 
-    image_id = uuid.uuid4().hex
+    # content_type is client-controlled: check the magic bytes before writing or decoding anything
+    head = await file.read(16)
+    if not head:
+        raise HTTPException(status_code=400, detail="Empty upload.")
+    if _sniff_image_format(head) is None:
+        raise HTTPException(status_code=415, detail="Unsupported image format.")
+
+    image_id = secrets.token_hex(16)
     ext = "jpg"
+    _ensure_project_dirs(project_id)
     paths = _paths_for(project_id, image_id, ext)
     tmp_upload = paths["original"].with_suffix(".upload")
+    # Fresh random id, so this never waits. Released once the upload is settled; a
+    # pending render takes it over (_finish_upload).
+    render_lock = _render_lock(image_id)
+    render_lock.acquire(timeout=0)
 
-    # We lock the entire operation to avoid:
-    # - two simultaneous "first uploads" both becoming primary
-    # - meta.json write races across processes
-    lock_handle = _with_project_lock(project_id)
+    pending = False
     try:
-        meta = _read_meta(project_id)
-
-        # Write temp upload
-        content = await file.read()
-        if not content:
-            raise HTTPException(status_code=400, detail="Empty upload.")
-        tmp_upload.write_bytes(content)
-
-        # Convert + generate sizes
-        _save_as_jpeg(tmp_upload, paths["original"], quality=JPEG_QUALITY_ORIGINAL)
-        _save_resized(paths["original"], paths["medium"], MEDIUM_MAX, quality=JPEG_QUALITY_DERIVED)
-        _save_resized(paths["original"], paths["thumb"], THUMB_MAX, quality=JPEG_QUALITY_DERIVED)
-        _save_fixed_square(paths["original"], paths["game"], GAME_IMG, quality=JPEG_QUALITY_DERIVED)
-
-        # Update meta
-        meta["images"].append({"id": image_id, "ext": ext, "created_at": _utc_now_iso()})
-        if meta.get("primary_image_id") is None:
-            meta["primary_image_id"] = image_id
-        _write_meta(project_id, meta)
+        # Stream the upload to a temp file so memory stays bounded per request
+        received = len(head)
+        hasher = hashlib.blake2b(head, digest_size=16)
+        async with aiofiles.open(tmp_upload, "wb") as out:
+            await out.write(head)
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                if received > MAX_UPLOAD_BYTES:
+                    # Backstop; oversized bodies are normally refused by _BodySizeLimit
+                    raise HTTPException(status_code=413, detail="Upload too large.")
+                hasher.update(chunk)
+                await out.write(chunk)
+
+        cas_dir = CAS_ROOT / f"{hasher.hexdigest()}-{_render_settings_tag()}"
+        # Same bytes uploaded before (any project): reuse its renders.
+        # Linking may fall back to copying full-size files, so keep it off the event loop.
+        if await run_in_threadpool(_link_from_cas, cas_dir, paths):
+            info = {**await run_in_threadpool(_original_info, paths["original"]), "status": "ready"}
+        else:
+            # Rendering happens after the response (_finish_upload). Parse the header now so
+            # files PIL can't identify still fail this request rather than the background job.
+            info = {**await run_in_threadpool(_image_dims, tmp_upload), "status": "processing"}
+            pending = True
 
     except HTTPException:
         raise
     except Exception as e:
+        _unlink_image_files(paths)
         raise HTTPException(status_code=400, detail=f"Invalid or unsupported image file: {e}")
     finally:
-        tmp_upload.unlink(missing_ok=True)
-        # release file lock
-        lock_handle.release()
+        if not pending:
+            tmp_upload.unlink(missing_ok=True)
+            _drop_render_lock(render_lock)
+
+    # Only the meta.json update is locked; the image files are private to this image_id.
+    # FileLock.acquire blocks while it waits, so it runs on the threadpool, not the event loop.
+    entry = {"id": image_id, "ext": ext, "created_at": _utc_now_iso(), "cas": cas_dir.name, **info}
+    try:
+        is_primary = await run_in_threadpool(_add_image_to_meta, project_id, entry)
+    except BaseException:
+        if pending:
+            tmp_upload.unlink(missing_ok=True)
+            _drop_render_lock(render_lock)
+        else:
+            await run_in_threadpool(_unlink_image_files, paths, cas_dir.name)
+        raise
+
+    if pending:
+        background_tasks.add_task(_finish_upload, project_id, image_id, tmp_upload, cas_dir, paths, render_lock)
+        response.status_code = 202
 
     return {
         "image_id": image_id,
         "project_id": project_id,
-        "is_primary": (meta.get("primary_image_id") == image_id),
-        "urls": {
-            "original": f"/projects/{project_id}/images/{image_id}?size=original",
-            "medium": f"/projects/{project_id}/images/{image_id}?size=medium",
-            "thumb": f"/projects/{project_id}/images/{image_id}?size=thumb",
-            "game": f"/projects/{project_id}/images/{image_id}?size=game",
-        },
+        "is_primary": is_primary,
+        "status": info["status"],
+        "urls": _urls_for(project_id, image_id),
     }
 
 
@@ -224,12 +950,14 @@ async def upload_image(project_id: str, file: UploadFile = File(...)) -> Dict[st
 # API: List images (project)
 # -----------------------------
 @app.get("/projects/{project_id}/images")
-def list_images(project_id: str) -> List[Dict[str, Any]]:
-    lock_handle = _with_project_lock(project_id)
-    try:
-        meta = _read_meta(project_id)
-    finally:
-        lock_handle.release()
+def list_images(project_id: str) -> Response:
+    # The serialized body is cached until meta.json changes
+    stamp = _meta_stamp(project_id)
+    cached = _LIST_CACHE.get(project_id)
+    if stamp is not None and cached and cached[0] == stamp:
+        return Response(cached[1], media_type="application/json")
+
+    meta, _ = _read_meta_unlocked(project_id)
 
     primary = meta.get("primary_image_id")
     out: List[Dict[str, Any]] = []
@@ -240,60 +968,64 @@ def list_images(project_id: str) -> List[Dict[str, Any]]:
                 "image_id": image_id,
                 "is_primary": (image_id == primary),
                 "created_at": img.get("created_at"),
-                "urls": {
-                    "original": f"/projects/{project_id}/images/{image_id}?size=original",
-                    "medium": f"/projects/{project_id}/images/{image_id}?size=medium",
-                    "thumb": f"/projects/{project_id}/images/{image_id}?size=thumb",
-                    "game": f"/projects/{project_id}/images/{image_id}?size=game",
-                },
+                "status": img.get("status", "ready"),
+                "width": img.get("width"),
+                "height": img.get("height"),
+                "size_bytes": img.get("size_bytes"),
+                "urls": _urls_for(project_id, image_id),
             }
         )
-    return out
+    body = orjson.dumps(out)
+    if stamp is not None:
+        _cache_put(_LIST_CACHE, project_id, (stamp, body))
+    return Response(body, media_type="application/json")
 
 
 # -----------------------------
 # API: Serve project thumbnail
 # -----------------------------
 @app.get("/projects/{project_id}/thumbnail")
-def project_thumbnail(project_id: str) -> FileResponse:
-    lock_handle = _with_project_lock(project_id)
+def project_thumbnail(project_id: str, request: Request) -> Response:
+    meta, index = _read_meta_unlocked(project_id)
+    primary = meta.get("primary_image_id")
+    if not primary:
+        raise HTTPException(status_code=404, detail="Project has no images yet.")
+    img = index.get(primary)
+    if not img:
+        raise HTTPException(status_code=404, detail="Primary image metadata missing.")
+    if img.get("status") == "processing":
+        raise HTTPException(status_code=409, detail="Primary image is still processing.")
+    paths = _paths_for(project_id, primary, img.get("ext", "jpg"))
+    # The primary image can change, so clients must revalidate (cheap: a 304 via ETag)
     try:
-        meta = _read_meta(project_id)
-        primary = meta.get("primary_image_id")
-        if not primary:
-            raise HTTPException(status_code=404, detail="Project has no images yet.")
-        img = _find_image_in_meta(meta, primary)
-        if not img:
-            raise HTTPException(status_code=404, detail="Primary image metadata missing.")
-        paths = _paths_for(project_id, primary, img.get("ext", "jpg"))
-        thumb_path = paths["thumb"]
-        if not thumb_path.exists():
-            raise HTTPException(status_code=404, detail="Thumbnail file missing on disk.")
-    finally:
-        lock_handle.release()
-
-    return FileResponse(thumb_path, media_type="image/jpeg")
+        return _image_response(request, paths["thumb"], "no-cache", webp_variant=True, in_memory=True)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Thumbnail file missing on disk.")
 
 
 # -----------------------------
 # API: Serve a specific image size
 # -----------------------------
 @app.get("/projects/{project_id}/images/{image_id}")
-def get_project_image(project_id: str, image_id: str, size: ImageSize = "original") -> FileResponse:
-    lock_handle = _with_project_lock(project_id)
+def get_project_image(project_id: str, image_id: str, request: Request, size: ImageSize = "original") -> Response:
+    _, index = _read_meta_unlocked(project_id)
+    img = index.get(image_id)
+    if not img:
+        raise HTTPException(status_code=404, detail="Image not found in this project.")
+    if img.get("status") == "processing":
+        raise HTTPException(status_code=409, detail="Image is still processing.")
+    paths = _paths_for(project_id, image_id, img.get("ext", "jpg"))
+    # Image files are never rewritten (new upload = new image_id)
     try:
-        meta = _read_meta(project_id)
-        img = _find_image_in_meta(meta, image_id)
-        if not img:
-            raise HTTPException(status_code=404, detail="Image not found in this project.")
-        paths = _paths_for(project_id, image_id, img.get("ext", "jpg"))
-        p = paths[size]
-        if not p.exists():
-            raise HTTPException(status_code=404, detail=f"{size} image missing on disk.")
-    finally:
-        lock_handle.release()
-
-    return FileResponse(p, media_type="image/jpeg")
+        return _image_response(
+            request,
+            paths[size],
+            IMMUTABLE_CACHE_CONTROL,
+            webp_variant=size in WEBP_SIZES,
+            in_memory=size in MEMORY_CACHED_SIZES,
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"{size} image missing on disk.")
 
 
 # -----------------------------
@@ -311,16 +1043,13 @@ def delete_project_image(project_id: str, image_id: str) -> Dict[str, Any]:
         ext = img.get("ext", "jpg")
         paths = _paths_for(project_id, image_id, ext)
 
-        # Remove files
-        for k in ("original", "medium", "thumb", "game"):
-            paths[k].unlink(missing_ok=True)
-
         # Update meta
-        meta["images"] = [x for x in meta["images"] if x.get("id") != image_id]
-        if meta.get("primary_image_id") == image_id:
-            meta["primary_image_id"] = meta["images"][0]["id"] if meta["images"] else None
+        _drop_from_meta(meta, image_id)
         _write_meta(project_id, meta)
 
+        # Remove files, and the CAS renders if this was their last user
+        _unlink_image_files(paths, img.get("cas"))
+
         return {
             "ok": True,
             "project_id": project_id,